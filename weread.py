@@ -12,6 +12,7 @@ Optional:
   WEREAD_USER_VID  (optional) if not set, will try to parse from cookie (wr_vid)
   ONLY_RECENT_DAYS (optional) int, if set will only sync highlights/notes newer than N days
   DRY_RUN          (optional) "1" to print payload count without posting to Readwise
+  FETCH_WORKERS    (optional) int, concurrent WeRead book fetches (default 8, max 16)
 
 This script:
 - Pulls bookshelf
@@ -28,11 +29,20 @@ import re
 import json
 import time
 import hashlib
+import functools
 import datetime as dt
-from dataclasses import dataclass
-from typing import Any, Dict, List, Optional, Tuple
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from dataclasses import dataclass, fields
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:  # optional speedup; stdlib json is fine
+    orjson = None
 
 
 READWISE_HIGHLIGHTS_API = "https://readwise.io/api/v2/highlights/"
@@ -45,6 +55,22 @@ UA = (
     "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
 )
 
+# runs of spaces/tabs, or 3+ newlines; collapsed in a single pass by _clean_text
+_RE_WS_RUN = re.compile(r"[ \t]+|\n{3,}")
+# anything _clean_text would change besides the outer strip()
+_RE_DIRTY = re.compile(r"[\r\t]|  |\n\n\n")
+
+# 19+ digit runs may not fit in 64 bits (see _json_loads)
+_RE_LONG_DIGITS = re.compile(rb"\d{19}")
+
+# books are fetched concurrently; keep the pool at least as large as the worker count
+FETCH_WORKERS = 8
+# Readwise allows ~240 req/min; a few in-flight POSTs is plenty
+POST_WORKERS = 4
+# max chunks submitted but not yet reported; bounds memory when Readwise is the bottleneck
+POST_BACKLOG = 2 * POST_WORKERS
+POOL_SIZE = 16
+
 
 @dataclass
 class Book:
@@ -68,37 +94,108 @@ class RWHighlight:
     external_source: str = "weread"
 
 
+# Readwise payload keys are exactly the RWHighlight field names
+RW_FIELDS = tuple(f.name for f in fields(RWHighlight))
+
+
 def _now_iso() -> str:
     return dt.datetime.now(dt.timezone.utc).isoformat().replace("+00:00", "Z")
 
 
+@functools.lru_cache(maxsize=4096)
 def _unix_to_iso(ts: int) -> str:
-    return dt.datetime.fromtimestamp(ts, tz=dt.timezone.utc).isoformat().replace("+00:00", "Z")
+    # highlights in a batch often share createTime, hence the cache
+    return "%04d-%02d-%02dT%02d:%02d:%02dZ" % time.gmtime(ts)[:6]
 
 
 def _clean_text(s: str) -> str:
-    if s is None:
+    if not s:
         return ""
-    s = s.replace("\r\n", "\n").replace("\r", "\n")
-    s = re.sub(r"[ \t]+", " ", s)
-    s = re.sub(r"\n{3,}", "\n\n", s).strip()
-    return s
+    if not _RE_DIRTY.search(s):
+        return s.strip()
+    if "\r" in s:
+        s = s.replace("\r\n", "\n").replace("\r", "\n")
+    return _RE_WS_RUN.sub(_squash_ws, s).strip()
+
 
+def _squash_ws(m: re.Match[str]) -> str:
+    return "\n\n" if m.group()[0] == "\n" else " "
 
-def _sha1(s: str) -> str:
-    return hashlib.sha1(s.encode("utf-8")).hexdigest()
+
+def _id_hash(s: str) -> str:
+    # dedup key only, not security-sensitive
+    return hashlib.blake2b(s.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _json_dumps(obj: Any) -> bytes:
+    # orjson refuses str with lone surrogates (which _json_loads lets through);
+    # stdlib json escapes them as \udXXX like the original json.dumps post did
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(obj).encode("utf-8")
+
+
+def _json_loads(data: bytes) -> Any:
+    # orjson is only a speedup: it rejects lone surrogate escapes / invalid UTF-8 and
+    # turns integers outside 64 bits into floats, so such bodies go through stdlib json
+    # (lenient decode, exact ints) like r.json() did. Strings decoded this way may carry
+    # lone surrogates, which is why _json_dumps has the matching stdlib fallback.
+    if orjson is not None and not _RE_LONG_DIGITS.search(data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data.decode("utf-8-sig", "replace"))
+
+
+def _pooled_session() -> requests.Session:
+    # keep-alive pool sized for concurrent fetches, with backoff on rate limits / 5xx.
+    # POST is safe to retry: Readwise dedupes highlights by external_id.
+    retry = Retry(
+        total=3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        backoff_factor=0.5,
+        allowed_methods=["GET", "POST"],
+        raise_on_status=False,  # let raise_for_status() report the final response
+    )
+    s = requests.Session()
+    s.mount("https://", HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry))
+    return s
 
 
 def _parse_cookie_value(cookie: str, key: str) -> Optional[str]:
-    # very tolerant cookie parser
-    m = re.search(rf"(?:^|;\s*){re.escape(key)}=([^;]+)", cookie)
-    return m.group(1) if m else None
+    # very tolerant cookie parser: "key=value" at the start or after ";" (+ optional spaces)
+    needle = key + "="
+    i = cookie.find(needle)
+    while i != -1:
+        j = i
+        while j > 0 and cookie[j - 1].isspace():
+            j -= 1
+        if i == 0 or (j > 0 and cookie[j - 1] == ";"):
+            start = i + len(needle)
+            end = cookie.find(";", start)
+            if end == -1:
+                end = len(cookie)
+            if end > start:
+                return cookie[start:end]
+        i = cookie.find(needle, i + 1)
+    return None
+
+
+def _iter_shelf_books(data: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    for k in ("finishReadBooks", "recentBooks", "allBooks"):
+        v = data.get(k)
+        if isinstance(v, list):
+            yield from v
 
 
 class WeReadClient:
     def __init__(self, cookie: str):
         self.cookie = cookie
-        self.s = requests.Session()
+        self.s = _pooled_session()
         self.s.headers.update(
             {
                 "User-Agent": UA,
@@ -112,7 +209,7 @@ class WeReadClient:
     def _get(self, url: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         r = self.s.get(url, params=params, timeout=30)
         r.raise_for_status()
-        return r.json()
+        return _json_loads(r.content)
 
     def bookshelf(self, user_vid: str) -> List[Book]:
         """
@@ -120,31 +217,23 @@ class WeReadClient:
         Returns a merged list of books.
         """
         data = self._get(f"{WEREAD_BASE_I}/shelf/friendCommon", params={"userVid": user_vid})
-        books_raw = []
-        for k in ("finishReadBooks", "recentBooks", "allBooks"):
-            if isinstance(data.get(k), list):
-                books_raw.extend(data[k])
-
-        seen = set()
-        out: List[Book] = []
-        for b in books_raw:
+        # first occurrence wins; dict keeps shelf order
+        books_raw: Dict[str, Dict[str, Any]] = {}
+        for b in _iter_shelf_books(data):
             book_id = str(b.get("bookId", ""))
             # filter non-book items (e.g., public accounts)
-            if not book_id.isdigit():
-                continue
-            if book_id in seen:
-                continue
-            seen.add(book_id)
-
-            out.append(
-                Book(
-                    book_id=book_id,
-                    title=str(b.get("title") or ""),
-                    author=str(b.get("author") or ""),
-                    cover=b.get("cover"),
-                )
+            if book_id.isdigit() and book_id not in books_raw:
+                books_raw[book_id] = b
+
+        return [
+            Book(
+                book_id=book_id,
+                title=str(b.get("title") or ""),
+                author=str(b.get("author") or ""),
+                cover=b.get("cover"),
             )
-        return out
+            for book_id, b in books_raw.items()
+        ]
 
     def bookmarklist(self, book_id: str) -> Dict[str, Any]:
         """
@@ -173,7 +262,7 @@ class WeReadClient:
 
 class ReadwiseClient:
     def __init__(self, token: str):
-        self.s = requests.Session()
+        self.s = _pooled_session()
         self.s.headers.update(
             {
                 "Authorization": f"Token {token}",
@@ -183,26 +272,21 @@ class ReadwiseClient:
         )
 
     def post_highlights(self, highlights: List[RWHighlight]) -> Dict[str, Any]:
-        payload = {
-            "highlights": [
-                {
-                    "text": h.text,
-                    "title": h.title,
-                    "author": h.author,
-                    "source_url": h.source_url,
-                    "highlighted_at": h.highlighted_at,
-                    "note": h.note,
-                    "location": h.location,
-                    "location_type": h.location_type,
-                    "external_id": h.external_id,
-                    "external_source": h.external_source,
-                }
-                for h in highlights
-            ]
-        }
-        r = self.s.post(READWISE_HIGHLIGHTS_API, data=json.dumps(payload), timeout=60)
+        # orjson serialises the dataclasses natively, skipping the per-highlight dicts.
+        # It rejects lone surrogates (see _json_dumps), so fall back to plain dicts +
+        # stdlib json on failure, not just when orjson is missing.
+        body: Optional[bytes] = None
+        if orjson is not None:
+            try:
+                body = orjson.dumps({"highlights": highlights})
+            except orjson.JSONEncodeError:
+                pass
+        if body is None:
+            items = [{k: getattr(h, k) for k in RW_FIELDS} for h in highlights]
+            body = json.dumps({"highlights": items}).encode("utf-8")
+        r = self.s.post(READWISE_HIGHLIGHTS_API, data=body, timeout=60)
         r.raise_for_status()
-        return r.json()
+        return _json_loads(r.content)
 
 
 def _weread_book_url(book_id: str) -> str:
@@ -210,17 +294,30 @@ def _weread_book_url(book_id: str) -> str:
     return f"{WEREAD_BASE_WEB}/web/reader/{book_id}"
 
 
-def _should_include(ts_unix: int, only_recent_days: Optional[int]) -> bool:
-    if not only_recent_days:
-        return True
-    cutoff = int(time.time()) - only_recent_days * 86400
-    return ts_unix >= cutoff
+# field-name candidates, in priority order (WeRead varies by client/version)
+_HL_KEYS = ("markText", "abstract", "content", "text")
+_NOTE_KEYS = ("review", "reviewContent", "note", "comment")
+_REVIEW_KEYS = ("content", "review", "text")
+
+
+def _first(item: Dict[str, Any], keys: Tuple[str, ...]) -> Any:
+    # first truthy value among keys, else ""
+    for k in keys:
+        v = item.get(k)
+        if v:
+            return v
+    return ""
+
+
+def _should_include(ts_unix: int, cutoff: Optional[int]) -> bool:
+    # cutoff is computed once per run from ONLY_RECENT_DAYS (None = no filter)
+    return cutoff is None or ts_unix >= cutoff
 
 
 def _extract_highlights_from_bookmarklist(
     book: Book,
     data: Dict[str, Any],
-    only_recent_days: Optional[int],
+    cutoff: Optional[int],
 ) -> List[RWHighlight]:
     chapters = {}
     for c in data.get("chapters", []) or []:
@@ -232,29 +329,30 @@ def _extract_highlights_from_bookmarklist(
     updated = data.get("updated", []) or []
     out: List[RWHighlight] = []
 
+    # per-book constants, hoisted out of the item loop
+    book_id = book.book_id
+    book_title = book.title
+    book_author = book.author
+    source_url = _weread_book_url(book_id)
+
     for item in updated:
-        # highlight text candidates (WeRead varies by client/version)
-        highlight_text = (
-            item.get("markText")
-            or item.get("abstract")
-            or item.get("content")
-            or item.get("text")
-            or ""
-        )
-        highlight_text = _clean_text(str(highlight_text))
+        # timestamp; filter first so skipped items cost no text cleanup
+        ts = int(item.get("createTime") or item.get("updated") or 0)
+        if ts <= 0:
+            # fall back to now if missing
+            ts = int(time.time())
+
+        if not _should_include(ts, cutoff):
+            continue
+
+        # highlight text
+        highlight_text = _clean_text(str(_first(item, _HL_KEYS)))
 
         if not highlight_text:
             continue
 
         # comment/note attached to highlight
-        comment = (
-            item.get("review")
-            or item.get("reviewContent")
-            or item.get("note")
-            or item.get("comment")
-            or ""
-        )
-        comment = _clean_text(str(comment))
+        comment = _clean_text(str(_first(item, _NOTE_KEYS)))
 
         # extra context
         chapter_uid = str(item.get("chapterUid") or "")
@@ -271,30 +369,21 @@ def _extract_highlights_from_bookmarklist(
         if location is not None:
             location = str(location)
 
-        # timestamp
-        ts = int(item.get("createTime") or item.get("updated") or 0)
-        if ts <= 0:
-            # fall back to now if missing
-            ts = int(time.time())
-
-        if not _should_include(ts, only_recent_days):
-            continue
-
         # stable external_id
         # prefer explicit bookmarkId; else hash a few stable fields
         bookmark_id = item.get("bookmarkId") or item.get("id") or ""
         if bookmark_id:
-            external_id = f"weread:{book.book_id}:bm:{bookmark_id}"
+            external_id = f"weread:{book_id}:bm:{bookmark_id}"
         else:
-            key = f"{book.book_id}|{location or ''}|{highlight_text}"
-            external_id = f"weread:{book.book_id}:h:{_sha1(key)}"
+            key = f"{book_id}|{location or ''}|{highlight_text}"
+            external_id = f"weread:{book_id}:h2:{_id_hash(key)}"
 
         out.append(
             RWHighlight(
                 text=highlight_text,
-                title=book.title,
-                author=book.author,
-                source_url=_weread_book_url(book.book_id),
+                title=book_title,
+                author=book_author,
+                source_url=source_url,
                 highlighted_at=_unix_to_iso(ts),
                 note=comment or None,
                 location=location,
@@ -309,7 +398,7 @@ def _extract_highlights_from_bookmarklist(
 def _extract_note_only_reviews(
     book: Book,
     data: Dict[str, Any],
-    only_recent_days: Optional[int],
+    cutoff: Optional[int],
 ) -> List[RWHighlight]:
     """
     Export WeRead 'thoughts' (review/list mine=1 listType=11) as standalone highlights,
@@ -324,25 +413,30 @@ def _extract_note_only_reviews(
             break
 
     out: List[RWHighlight] = []
-    for r in reviews:
-        content = r.get("content") or r.get("review") or r.get("text") or ""
-        content = _clean_text(str(content))
-        if not content:
-            continue
 
+    book_id = book.book_id
+    book_title = book.title
+    book_author = book.author
+    source_url = _weread_book_url(book_id)
+
+    for r in reviews:
         ts = int(r.get("createTime") or r.get("ctime") or 0)
         if ts <= 0:
             ts = int(time.time())
 
-        if not _should_include(ts, only_recent_days):
+        if not _should_include(ts, cutoff):
+            continue
+
+        content = _clean_text(str(_first(r, _REVIEW_KEYS)))
+        if not content:
             continue
 
         review_id = r.get("reviewId") or r.get("id") or ""
         if review_id:
-            external_id = f"weread:{book.book_id}:rv:{review_id}"
+            external_id = f"weread:{book_id}:rv:{review_id}"
         else:
-            key = f"{book.book_id}|review|{content}"
-            external_id = f"weread:{book.book_id}:rvh:{_sha1(key)}"
+            key = f"{book_id}|review|{content}"
+            external_id = f"weread:{book_id}:rvh2:{_id_hash(key)}"
 
         # Put the thought itself as highlight text (searchable in Readwise)
         # and also keep a small label in note.
@@ -351,9 +445,9 @@ def _extract_note_only_reviews(
         out.append(
             RWHighlight(
                 text=content,
-                title=book.title,
-                author=book.author,
-                source_url=_weread_book_url(book.book_id),
+                title=book_title,
+                author=book_author,
+                source_url=source_url,
                 highlighted_at=_unix_to_iso(ts),
                 note=note,
                 location=None,
@@ -364,6 +458,37 @@ def _extract_note_only_reviews(
     return out
 
 
+def _fetch_book(
+    wr: WeReadClient,
+    book: Book,
+    cutoff: Optional[int],
+) -> Tuple[List[RWHighlight], List[RWHighlight]]:
+    # raw responses are not kept around: each is dropped as soon as it's extracted,
+    # so a worker never holds the bookmarklist JSON while waiting on review/list
+    hs = _extract_highlights_from_bookmarklist(book, wr.bookmarklist(book.book_id), cutoff)
+    ns = _extract_note_only_reviews(book, wr.my_reviews(book.book_id), cutoff)
+    return hs, ns
+
+
+def _reap_posts(posts: Dict[Future, int], sent: int, block: bool) -> int:
+    """
+    Report finished Readwise POSTs (all of them if block=True), dropping them from `posts`.
+    Returns the updated count of highlights sent; re-raises the first failed POST.
+    """
+    finished = as_completed(list(posts)) if block else [f for f in posts if f.done()]
+    for fut in finished:
+        resp = fut.result()
+        sent += posts.pop(fut)
+        print(f"Posted {sent}. Readwise response keys={list(resp.keys())}")
+    return sent
+
+
+def _cancel_pending(*executors: ThreadPoolExecutor) -> None:
+    # drop queued work so leaving the `with` only waits for tasks already running
+    for ex in executors:
+        ex.shutdown(wait=False, cancel_futures=True)
+
+
 def main() -> None:
     weread_cookie = os.environ.get("WEREAD_COOKIE", "").strip()
     readwise_token = os.environ.get("READWISE_TOKEN", "").strip()
@@ -385,9 +510,16 @@ def main() -> None:
 
     only_recent_days = os.environ.get("ONLY_RECENT_DAYS", "").strip()
     only_recent_days_int: Optional[int] = int(only_recent_days) if only_recent_days else None
+    cutoff: Optional[int] = (
+        int(time.time()) - only_recent_days_int * 86400 if only_recent_days_int else None
+    )
 
     dry_run = os.environ.get("DRY_RUN", "").strip() == "1"
 
+    # never exceed the connection pool, or workers end up waiting on / churning sockets
+    fetch_workers = os.environ.get("FETCH_WORKERS", "").strip()
+    fetch_workers_int = max(1, min(int(fetch_workers) if fetch_workers else FETCH_WORKERS, POOL_SIZE))
+
     wr = WeReadClient(weread_cookie)
     rw = ReadwiseClient(readwise_token)
 
@@ -396,37 +528,62 @@ def main() -> None:
         print("No books found on bookshelf.")
         return
 
-    all_highlights: List[RWHighlight] = []
-    for i, book in enumerate(books, 1):
-        try:
-            bm = wr.bookmarklist(book.book_id)
-            hs = _extract_highlights_from_bookmarklist(book, bm, only_recent_days_int)
-            all_highlights.extend(hs)
-
-            rv = wr.my_reviews(book.book_id)
-            ns = _extract_note_only_reviews(book, rv, only_recent_days_int)
-            all_highlights.extend(ns)
-
-            print(f"[{i}/{len(books)}] {book.title} -> highlights={len(hs)} notes={len(ns)}")
-        except Exception as e:
-            print(f"[{i}/{len(books)}] {book.title} -> ERROR: {e}")
-
     # If huge, chunk to avoid request size issues
     CHUNK = 200
-    print(f"Total to sync: {len(all_highlights)}")
-    if dry_run:
-        print("DRY_RUN=1, skipping Readwise post.")
-        return
 
+    # Books are fetched in parallel (I/O bound) and their highlights are posted to
+    # Readwise as soon as a full chunk is buffered, so uploads overlap with fetching
+    # and only the unsent tail + at most POST_BACKLOG chunks are held in memory.
+    total = 0
     sent = 0
-    for start in range(0, len(all_highlights), CHUNK):
-        chunk = all_highlights[start : start + CHUNK]
-        if not chunk:
-            continue
-        resp = rw.post_highlights(chunk)
-        sent += len(chunk)
-        print(f"Posted {sent}/{len(all_highlights)}. Readwise response keys={list(resp.keys())}")
+    buf: List[RWHighlight] = []
+    posts: Dict[Future, int] = {}
+    with ThreadPoolExecutor(max_workers=POST_WORKERS) as post_ex:
+        with ThreadPoolExecutor(max_workers=fetch_workers_int) as fetch_ex:
+            futures = {fetch_ex.submit(_fetch_book, wr, book, cutoff): book for book in books}
+            try:
+                for done, fut in enumerate(as_completed(futures), 1):
+                    book = futures.pop(fut)  # let finished results be freed
+                    try:
+                        hs, ns = fut.result()
+                    except Exception as e:
+                        print(f"[{done}/{len(books)}] {book.title} -> ERROR: {e}")
+                        continue
+                    print(f"[{done}/{len(books)}] {book.title} -> highlights={len(hs)} notes={len(ns)}")
+                    total += len(hs) + len(ns)
+                    if dry_run:
+                        continue
+
+                    buf.extend(hs)
+                    buf.extend(ns)
+                    while len(buf) >= CHUNK:
+                        # backpressure: if Readwise is slower than WeRead, wait for a slot
+                        # rather than queueing the whole library inside the executor
+                        if len(posts) >= POST_BACKLOG:
+                            wait(posts, return_when=FIRST_COMPLETED)
+                            sent = _reap_posts(posts, sent, block=False)
+                        posts[post_ex.submit(rw.post_highlights, buf[:CHUNK])] = CHUNK
+                        del buf[:CHUNK]
+                    sent = _reap_posts(posts, sent, block=False)
+            except BaseException:
+                # e.g. a failed POST (revoked token): stop now instead of draining the shelf
+                _cancel_pending(fetch_ex, post_ex)
+                raise
+
+        print(f"Total to sync: {total}")
+        if dry_run:
+            print("DRY_RUN=1, skipping Readwise post.")
+            return
+
+        if buf:
+            posts[post_ex.submit(rw.post_highlights, buf)] = len(buf)
+        try:
+            sent = _reap_posts(posts, sent, block=True)
+        except BaseException:
+            _cancel_pending(post_ex)
+            raise
 
+    print(f"Posted {sent}/{total}.")
     print("Done.")
 
 